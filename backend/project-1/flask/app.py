@@ -1,18 +1,42 @@
-from sentence_transformers import SentenceTransformer
+import os
+
+# Use every core for intra-op parallelism; must be set before the runtimes are imported
+os.environ.setdefault("OMP_NUM_THREADS", str(os.cpu_count()))
+os.environ.setdefault("MKL_NUM_THREADS", str(os.cpu_count()))
+
+from optimum.onnxruntime import ORTModelForFeatureExtraction
+from transformers import AutoTokenizer
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from pinecone import Pinecone
-from groq import Groq
+from pinecone.grpc import PineconeGRPC as Pinecone
+from cachetools import TTLCache
+from functools import lru_cache
+from filter_rules import extract_filter
+from groq import Groq, APIError
+import onnxruntime as ort
+import numpy as np
+import threading
+import hashlib
 import json
-import os
 
 
 load_dotenv()
 
 app = Flask(__name__)
 
+EMBED_MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
+EMBED_MAX_LENGTH = 384
+
+# Quantized ONNX export of the embedding model, produced by export_onnx_model.py
+ONNX_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx_mpnet")
+ONNX_MODEL_FILE = "model_optimized_quantized.onnx"
+
 INDEX_NAME = "stocks"
 NAMESPACE = "stock-descriptions"
+TOP_K = 10
+
+# Only used for queries the rule-based filter extraction cannot fully handle
+FILTER_MODEL = "llama3-8b-8192"
 
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
@@ -20,56 +44,477 @@ PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 groq_client = Groq(api_key=GROQ_API_KEY)
 pinecone_client = Pinecone(api_key=PINECONE_API_KEY)
 
-def get_huggingface_embeddings(text, model_name="sentence-transformers/all-mpnet-base-v2"):
+# The gRPC channel and the ONNX Runtime thread pool are not fork-safe, so both are
+# created lazily on first use in each worker process rather than at import time
+_resources_lock = threading.Lock()
+_pinecone_index = None
+_embed_model = None
+_embed_tokenizer = None
+
+def get_pinecone_index():
+
+    """
+    Returns this process's Pinecone index handle, resolving the index host and
+    opening the gRPC channel on first use.
+    """
+
+    global _pinecone_index
+
+    if _pinecone_index is None:
+        with _resources_lock:
+            if _pinecone_index is None:
+                _pinecone_index = pinecone_client.Index(INDEX_NAME)
+
+    return _pinecone_index
+
+def get_embed_model():
+
+    """
+    Returns this process's ONNX embedding model and tokenizer, loading them on first use.
+    Falls back to an on-the-fly FP32 ONNX export if the quantized model has not been built.
+
+    Returns:
+        tuple: The ORTModelForFeatureExtraction and its tokenizer.
+    """
+
+    global _embed_model, _embed_tokenizer
+
+    if _embed_model is None:
+        with _resources_lock:
+            if _embed_model is None:
+
+                session_options = ort.SessionOptions()
+                session_options.intra_op_num_threads = int(os.environ["OMP_NUM_THREADS"])
+
+                if os.path.isfile(os.path.join(ONNX_MODEL_DIR, ONNX_MODEL_FILE)):
+                    _embed_tokenizer = AutoTokenizer.from_pretrained(ONNX_MODEL_DIR)
+                    _embed_model = ORTModelForFeatureExtraction.from_pretrained(ONNX_MODEL_DIR, file_name=ONNX_MODEL_FILE, provider="CPUExecutionProvider", session_options=session_options)
+                else:
+                    _embed_tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL_NAME)
+                    _embed_model = ORTModelForFeatureExtraction.from_pretrained(EMBED_MODEL_NAME, export=True, provider="CPUExecutionProvider", session_options=session_options)
+
+    return _embed_model, _embed_tokenizer
+
+# Process-local cache of Pinecone query results, keyed by (filter, question, top_k)
+QUERY_CACHE = TTLCache(maxsize=1024, ttl=300)
+QUERY_CACHE_LOCK = threading.RLock()
+QUERY_CACHE_STATS = {"hits": 0, "misses": 0}
+
+# Process-local cache of extracted filters, keyed by the user query hash
+FILTER_CACHE = TTLCache(maxsize=1024, ttl=300)
+FILTER_CACHE_LOCK = threading.RLock()
+FILTER_CACHE_STATS = {"hits": 0, "misses": 0}
+
+def encode(texts):
+
+    """
+    Embeds texts with the ONNX model, reproducing the sentence-transformers
+    mean pooling and L2 normalization of all-mpnet-base-v2.
+
+    Args:
+        texts (list): The input texts to embed.
+
+    Returns:
+        np.ndarray: The embeddings, one row per text.
+    """
+
+    embed_model, embed_tokenizer = get_embed_model()
+
+    inputs = embed_tokenizer(texts, padding=True, truncation=True, max_length=EMBED_MAX_LENGTH, return_tensors="np")
+    token_embeddings = embed_model(**inputs).last_hidden_state
+
+    mask = inputs["attention_mask"][..., None].astype(token_embeddings.dtype)
+    embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+    
+    return embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+
+@lru_cache(maxsize=4096)
+def _encode_normalized(text):
+
+    return tuple(encode([text])[0].tolist())
+
+def get_huggingface_embeddings(text):
     
     """
-    Generates embeddings for the given text using a specified Hugging Face model.
+    Generates embeddings for the given text using the process's Hugging Face model.
+    Results are cached on the lowercased, stripped text.
 
     Args:
         text (str): The input text to generate embeddings for.
-        model_name (str): The name of the Hugging Face model to use.
-                          Defaults to "sentence-transformers/all-mpnet-base-v2".
 
     Returns:
-        np.ndarray: The generated embeddings as a NumPy array.
+        list: The generated embeddings as a list of floats.
     """
 
-    model = SentenceTransformer(model_name)
-    return model.encode(text).tolist()
+    return list(_encode_normalized(text.strip().lower()))
 
-def get_augmented_context(formatted_response):
+def _query_cache_key(filter, question, top_k):
 
-    pinecone_index = pinecone_client.Index(INDEX_NAME)
+    question_hash = hashlib.sha256(question.strip().lower().encode("utf-8")).hexdigest()
+    return (json.dumps(filter, sort_keys=True), question_hash, top_k)
 
-    filter = formatted_response["filter"]
-    print(filter)
-    question = formatted_response["question"]
+def query_pinecone(filter, question, top_k=TOP_K):
+
+    """
+    Queries Pinecone for the closest matches to the question, serving repeated
+    queries from a TTL cache so neither the embedding nor the query is recomputed.
+
+    Args:
+        filter (dict): The Pinecone metadata filter.
+        question (str): The question to embed and search for.
+        top_k (int): The number of matches to return.
+
+    Returns:
+        list: The matches returned by Pinecone.
+    """
+
+    key = _query_cache_key(filter, question, top_k)
+
+    with QUERY_CACHE_LOCK:
+        
+        matches = QUERY_CACHE.get(key)
+
+        if matches is not None:
+            QUERY_CACHE_STATS["hits"] += 1
+            return matches
+
+        QUERY_CACHE_STATS["misses"] += 1
 
     question_embeddings = get_huggingface_embeddings(question)
 
-    top_matches = pinecone_index.query(
+    top_matches = get_pinecone_index().query(
         namespace=NAMESPACE,
         vector=question_embeddings,
         filter=filter,
-        top_k=10,
+        top_k=top_k,
         include_metadata=True
     )
 
     print(top_matches)
 
-    context = [item['metadata']['text'] for item in top_matches['matches']]
-    augmented_context = "<CONTEXT>\n" + "\n\n-------\n\n".join(context[ : 10]) + "\n-------\n</CONTEXT>\n\n\n\n"
+    matches = top_matches['matches']
+
+    with QUERY_CACHE_LOCK:
+        QUERY_CACHE[key] = matches
+
+    return matches
+
+# Static instructions for filter extraction, sent as the system message so the
+# prefix is identical across requests and only the user query varies
+FILTER_SYSTEM_PROMPT = """
+You are a pinecone vector database expert. Stock data is indexed in the vector database with the following metadata:
+
+metadata: {
+    "Analyst Recommendation": "string",
+    "Business Summary": "string",
+    "City": "string",
+    "Country": "string",
+    "Industry": "string",
+    "Market Cap": "number",
+    "Name": "string",
+    "PE Ratio": "number",
+    "Price": "number",
+    "Sector": "string",
+    "State": "string",
+    "Ticker": "string",
+    "Volume": "number"
+}
+
+For "Analyst Recommendation", the values can be "buy", "hold", or "sell".
+For "Sector", the values can be "Basic Materials", "Communication Services", "Consumer Cyclical", "Consumer Defensive", "Energy", "Financial Services", "Healthcare", "Industrials", "Real Estate", "Technology", "Utilities".
+For "State", the values are the 2-letter codes for the states in the United States.
+For "City", the values are the names of cities.
+For "Country", the values are the names of countries.
+
+Given the user query, extract the information that can be used to filter the vector database by metadata into "filter", and put the rest of the query into "question". The question should be usable to query the vector database based on embeddings.
+
+For the filter you should only use the following operators:
+
+Filter	        Description
+$eq	            Matches vectors with a field equal to the value.
+$ne	            Matches vectors with a field not equal to the value.
+$gt	            Matches vectors with a field greater than the value.
+$gte	        Matches vectors with a field greater than or equal to the value.
+$lt	            Matches vectors with a field less than the value.
+$lte	        Matches vectors with a field less than or equal to the value.
+$in	            Matches vectors with a field in the list of values.
+$nin	        Matches vectors with a field not in the list of values.
+$exists	        Matches vectors with the field.
+
+Operator	    Description
+$and	        Matches vectors that match every filter in the list.
+$or	            Matches vectors that match any filter in the list.
+
+If you aren't sure about the filter, respond with an empty filter.
+"""
+
+# JSON mode does not enforce a schema, so the expected shape is spelled out in the prompt
+FILTER_JSON_MODE_INSTRUCTIONS = """
+Respond with a JSON object with exactly two keys: "filter", the metadata filter (an empty object if there is none), and "question", the rest of the user query.
+"""
+
+# Metadata fields that can be filtered on, with the operators allowed for each value type
+FILTER_FIELDS = {
+    "Analyst Recommendation": "string",
+    "City": "string",
+    "Country": "string",
+    "Industry": "string",
+    "Market Cap": "number",
+    "Name": "string",
+    "PE Ratio": "number",
+    "Price": "number",
+    "Sector": "string",
+    "State": "string",
+    "Ticker": "string",
+    "Volume": "number"
+}
+
+FILTER_OPERATORS = {
+    "string": ["$eq", "$ne", "$in", "$nin", "$exists"],
+    "number": ["$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin", "$exists"]
+}
+
+def _condition_schema(value_type):
+
+    properties = {}
+
+    for operator in FILTER_OPERATORS[value_type]:
+        if operator in ("$in", "$nin"):
+            properties[operator] = {"type": "array", "items": {"type": value_type}, "minItems": 1}
+        elif operator == "$exists":
+            properties[operator] = {"type": "boolean"}
+        else:
+            properties[operator] = {"type": value_type}
+
+    return {"type": "object", "properties": properties, "minProperties": 1, "additionalProperties": False}
+
+FILTER_RESPONSE_SCHEMA = {
+    "name": "metadata_filter",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "filter": {
+                "$ref": "#/$defs/filter",
+                "description": "Pinecone metadata filter built from the operators above."
+            },
+            "question": {
+                "type": "string",
+                "description": "The rest of the user query that cannot be expressed as a metadata filter."
+            }
+        },
+        "required": ["filter", "question"],
+        "additionalProperties": False,
+        "$defs": {
+            "filter": {
+                "type": "object",
+                "properties": {
+                    **{field: _condition_schema(value_type) for field, value_type in FILTER_FIELDS.items()},
+                    "$and": {"type": "array", "items": {"$ref": "#/$defs/filter"}, "minItems": 1},
+                    "$or": {"type": "array", "items": {"$ref": "#/$defs/filter"}, "minItems": 1}
+                },
+                "additionalProperties": False
+            }
+        }
+    }
+}
+
+def _is_value(value, value_type):
+
+    if value_type == "number":
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    return isinstance(value, str)
+
+def is_valid_filter(filter):
 
-    return augmented_context
+    """
+    Checks that a filter only uses the known metadata fields, the operators allowed
+    for each field's type, and values of the right type.
 
-def get_question(formatted_response):
+    Args:
+        filter (dict): The Pinecone metadata filter to check.
+
+    Returns:
+        bool: True if Pinecone can be queried with the filter.
+    """
+
+    if not isinstance(filter, dict) or not filter:
+        return False
+
+    for key, value in filter.items():
+
+        if key in ("$and", "$or"):
+            if not isinstance(value, list) or not value or not all(is_valid_filter(item) for item in value):
+                return False
+            continue
+
+        value_type = FILTER_FIELDS.get(key)
+
+        if value_type is None or not isinstance(value, dict) or not value:
+            return False
+
+        for operator, operand in value.items():
+
+            if operator not in FILTER_OPERATORS[value_type]:
+                return False
 
+            if operator in ("$in", "$nin"):
+                valid = isinstance(operand, list) and operand and all(_is_value(item, value_type) for item in operand)
+            elif operator == "$exists":
+                valid = isinstance(operand, bool)
+            else:
+                valid = _is_value(operand, value_type)
+
+            if not valid:
+                return False
+
+    return True
+
+def parse_filter_response(content, user_query):
+
+    """
+    Validates the filter extraction response against FILTER_RESPONSE_SCHEMA.
+    Filters that use unknown fields, operators or value types are dropped, and the
+    original user query is used as the question in their place.
+
+    Args:
+        content (str): The JSON content returned by the LLM.
+        user_query (str): The original user query, used as the question if none was extracted.
+
+    Returns:
+        dict: A dictionary with a "filter" (dict or None) and a "question" (str).
+    """
+
+    try:
+        response = json.loads(content)
+    except json.JSONDecodeError:
+        response = {}
+
+    if not isinstance(response, dict):
+        response = {}
+
+    filter = response.get("filter")
+    question = response.get("question")
+
+    # The question was written assuming the filter would be applied, so if the
+    # filter is rejected its constraints would be lost; search with the full query instead
+    if filter and not is_valid_filter(filter):
+        return {"filter": None, "question": user_query}
+
+    return {
+        "filter": filter or None,
+        "question": question if isinstance(question, str) and question.strip() else user_query
+    }
+
+def request_filter_extraction(user_query):
+
+    """
+    Asks the LLM to split the user query into a filter and a question. Uses the strict
+    JSON schema when the model supports it and falls back to plain JSON mode otherwise.
+
+    Args:
+        user_query (str): The natural language query.
+
+    Returns:
+        str: The JSON content returned by the LLM, or None if both requests failed.
+    """
+
+    try:
+        response = groq_client.chat.completions.create(
+            model=FILTER_MODEL,
+            messages=[
+                {"role": "system", "content": FILTER_SYSTEM_PROMPT},
+                {"role": "user", "content": user_query}
+            ],
+            response_format={"type": "json_schema", "json_schema": FILTER_RESPONSE_SCHEMA}
+        )
+
+        return response.choices[0].message.content
+
+    except APIError as e:
+        print(f"JSON SCHEMA FILTER EXTRACTION FAILED, RETRYING IN JSON MODE: {e}")
+
+    try:
+        response = groq_client.chat.completions.create(
+            model=FILTER_MODEL,
+            messages=[
+                {"role": "system", "content": FILTER_SYSTEM_PROMPT + FILTER_JSON_MODE_INSTRUCTIONS},
+                {"role": "user", "content": user_query}
+            ],
+            response_format={"type": "json_object"}
+        )
+
+        return response.choices[0].message.content
+
+    except APIError as e:
+        print(f"FILTER EXTRACTION FAILED: {e}")
+        return None
+
+def get_filter_response(user_query):
+
+    """
+    Splits the user query into a metadata filter and a question. Rule-based extraction
+    is tried first and the LLM is only called when the rules can't account for every
+    filterable phrase in the query. Results are cached.
+
+    Args:
+        user_query (str): The natural language query.
+
+    Returns:
+        dict: A dictionary with a "filter" (dict or None) and a "question" (str).
+    """
+
+    key = hashlib.sha256(user_query.strip().lower().encode("utf-8")).hexdigest()
+
+    with FILTER_CACHE_LOCK:
+
+        formatted_response = FILTER_CACHE.get(key)
+
+        if formatted_response is not None:
+            FILTER_CACHE_STATS["hits"] += 1
+            return formatted_response
+
+        FILTER_CACHE_STATS["misses"] += 1
+
+    formatted_response = extract_filter(user_query)
+
+    if formatted_response is None:
+
+        content = request_filter_extraction(user_query)
+
+        # Don't cache the degraded response so the LLM is retried on the next request
+        if content is None:
+            return {"filter": None, "question": user_query}
+
+        formatted_response = parse_filter_response(content, user_query)
+
+    with FILTER_CACHE_LOCK:
+        FILTER_CACHE[key] = formatted_response
+
+    return formatted_response
+
+def get_augmented_context(formatted_response):
+
+    filter = formatted_response["filter"]
+    print(filter)
     question = formatted_response["question"]
-    augmented_question = f"""
+
+    matches = query_pinecone(filter, question)
+
+    context = "\n\n-------\n\n".join(item['metadata']['text'] for item in matches)
+    augmented_context = f"<CONTEXT>\n{context}\n-------\n</CONTEXT>\n\n\n\n"
+
+    return augmented_context
+
+# Static text around the question in the final prompt, joined per request
+# without going through f-string interpolation of the whole template
+QUESTION_PREFIX = """
     MY QUESTION:
 
     Using ONLY the context provided, answer the following question:
-    {question}
+    """
+
+QUESTION_SUFFIX = """
 
     You should mention all the companies that are mentioned in the context. In your answer, I expect to see at least the company name, ticker, and the reason why you think it is relevant to the question.
 
@@ -79,6 +524,11 @@ def get_question(formatted_response):
     
     """
 
+def get_question(formatted_response):
+
+    question = formatted_response["question"]
+    augmented_question = "".join([QUESTION_PREFIX, question, QUESTION_SUFFIX])
+
     return augmented_question
 
 def generate_prompt(formatted_response):
@@ -96,105 +546,30 @@ def explore():
     data = request.json
     user_query = data["user_query"]
     
-    prompt = f"""
-    You are a pinecone vector database expert. I have indexed stock data into the vector database in the following structure:
-
-    metadata: {{
-        "Analyst Recommendation": "string"
-        "Business Summary": "string",
-        "City": "string",
-        "Country": "string",
-        "Industry": "string",
-        "Market Cap": "number",
-        "Name": "string",
-        "PE Ratio": "number",
-        "Price": "number",
-        "Sector": "string",
-        "State": "string",
-        "Ticker": "string",
-        "Volume": "number",
-    }}
-
-    For "Analyst Recommendation", the values can be "buy", "hold", or "sell".
-    For "Sector", the values can be "Communication Services", "Consumer Discretionary", "Consumer Staples", "Energy", "Financials", "Healthcare", "Industrials", "Technology", "Materials", "Real Estate", "Utilities".
-    For "State", the values are the 2-letter codes for the states in the United States.
-    For "City", the values are the names of cities.
-    For "Country", the values are the names of countries.
-
-    Now given the following user query:
-
-    <USER QUERY>
-    {user_query}
-    </USER QUERY>
-
-    Extract the information from the user query that can be used to filter the vector database by metadata. 
-
-    I want you to respond in the following JSON format:
-
-    <JSON FORMAT>
-    {{
-        "filter": {{
-            "Market Cap": {{
-                "$gte": 10_000_000_000
-            }},
-        }},
-        "question": <the rest of the user query that cannot be used to filter the vector database using metadata>
-    }}
-
-    OR
-
-    {{
-        "filter": {{
-            "$and": [
-                {{
-                    "Market Cap": {{
-                        "$gte": 10_000_000_000
-                    }}, 
-                }},
-                {{
-                    "Sector": {{
-                        "$eq": "Technology"
-                    }},
-                }},
-            ]
-        }},
-        "question": <the rest of the user query that cannot be used to filter the vector database using metadata. It should be a question that can be used to query the vector database based on embeddings>
-    }}
-    </JSON FORMAT>
-
-    Note that for the filter you should only use the following operators:
-
-    Filter	        Example	                                                Description
-    $eq	            {{"genre": {{"$eq": "documentary"}}}}	                Matches vectors with the genre “documentary”.
-    $ne	            {{"genre": {{"$ne": "drama"}}}}	                        Matches vectors with a genre other than “drama”.
-    $gt	            {{"year": {{"$gt": 2019}}}}	                            Matches vectors with a year greater than 2019.
-    $gte	        {{"year": {{"$gte": 2020}}}}	                        Matches vectors with a year greater than or equal to 2020.
-    $lt	            {{"year": {{"$lt": 2020}}}}	                            Matches vectors with a year less than 2020.
-    $lte	        {{"year": {{"$lte": 2020}}}}	                        Matches vectors with a year less than or equal to 2020.
-    $in	            {{"genre": {{"$in": ["comedy", "documentary"]}}}}	    Matches vectors with the genre “comedy” or “documentary”.
-    $nin	        {{"genre": {{"$nin": ["comedy", "documentary"]}}}}	    Matches vectors with a genre other than “comedy” or “documentary”.
-    $exists	        {{"genre": {{"$exists": true}}}}	                    Matches vectors with the “genre” field.
-
-    Operator	    Example	                                                                        Description
-    $and	        {{"$and": [{{"genre": {{"$eq": "drama"}}, {{"year": {{"$gte": 2020"}}}}]}}	    Matches vectors with the genre “drama” and a year greater than or equal to 2020.
-    $or	            {{"$or": [{{"genre": {{"$eq": "drama"}}, {{"year": {{"$gte": 2020"}}}}]}}	    Matches vectors with the genre “drama” or a year greater than or equal to 2020.
-
-    If you aren't sure about the filter, you should not include it in the JSON. 
-
-    Please consider the all the above information when responding, and take your time in understanding the user query. If necessary break down the problem into smaller steps.
-    """
-
-    response = groq_client.chat.completions.create(
-        model="llama3-70b-8192",
-        messages=[{"role": "user", "content": prompt}],
-        response_format={"type": "json_object"}
-    )
-
-    formatted_response = json.loads(response.choices[0].message.content)
+    formatted_response = get_filter_response(user_query)
 
     prompt = generate_prompt(formatted_response)
 
     return jsonify({"prompt": prompt}), 200
 
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000)
+@app.route("/stats", methods=["GET"])
+def stats():
+
+    embedding_stats = _encode_normalized.cache_info()
+
+    with QUERY_CACHE_LOCK:
+        query_stats = dict(QUERY_CACHE_STATS, size=len(QUERY_CACHE), maxsize=QUERY_CACHE.maxsize)
+
+    with FILTER_CACHE_LOCK:
+        filter_stats = dict(FILTER_CACHE_STATS, size=len(FILTER_CACHE), maxsize=FILTER_CACHE.maxsize)
+
+    return jsonify({
+        "embedding_cache": {
+            "hits": embedding_stats.hits,
+            "misses": embedding_stats.misses,
+            "size": embedding_stats.currsize,
+            "maxsize": embedding_stats.maxsize
+        },
+        "query_cache": query_stats,
+        "filter_cache": filter_stats
+    }), 200
@@ -0,0 +1,46 @@
+from optimum.onnxruntime.configuration import AutoOptimizationConfig, AutoQuantizationConfig
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTOptimizer, ORTQuantizer
+from transformers import AutoTokenizer
+import os
+
+EMBED_MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
+ONNX_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx_mpnet")
+
+# Written by the optimizer, then suffixed with "_quantized" by the quantizer
+OPTIMIZED_MODEL_FILE = "model_optimized.onnx"
+ONNX_MODEL_FILE = "model_optimized_quantized.onnx"
+
+def export_onnx_model(model_name: str = EMBED_MODEL_NAME, save_dir: str = ONNX_MODEL_DIR) -> None:
+
+    """
+    Exports the embedding model to ONNX, applies O3 graph optimization and then
+    dynamic INT8 quantization (AVX512-VNNI) so it can be served with ONNX Runtime on CPU.
+
+    Args:
+        model_name (str): The Hugging Face model to export.
+        save_dir (str): The directory to write the quantized model and tokenizer to.
+    """
+
+    print("EXPORTING MODEL TO ONNX...")
+
+    model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+    model.save_pretrained(save_dir)
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(save_dir)
+
+    print("OPTIMIZING MODEL...")
+
+    optimizer = ORTOptimizer.from_pretrained(model)
+    optimizer.optimize(save_dir=save_dir, optimization_config=AutoOptimizationConfig.O3())
+
+    print("QUANTIZING MODEL...")
+
+    quantizer = ORTQuantizer.from_pretrained(save_dir, file_name=OPTIMIZED_MODEL_FILE)
+    quantizer.quantize(
+        save_dir=save_dir,
+        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    )
+
+    print(f"SAVED QUANTIZED MODEL TO '{os.path.join(save_dir, ONNX_MODEL_FILE)}'")
+
+if __name__ == '__main__':
+    export_onnx_model()
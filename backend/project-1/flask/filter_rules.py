@@ -0,0 +1,158 @@
+import re
+
+# Keywords for the "Sector" metadata values, which are Yahoo Finance's sector names
+SECTOR_KEYWORDS = {
+    "basic materials": "Basic Materials",
+    "materials": "Basic Materials",
+    "communication services": "Communication Services",
+    "telecom": "Communication Services",
+    "consumer cyclical": "Consumer Cyclical",
+    "consumer discretionary": "Consumer Cyclical",
+    "consumer defensive": "Consumer Defensive",
+    "consumer staples": "Consumer Defensive",
+    "energy": "Energy",
+    "financial services": "Financial Services",
+    "financials": "Financial Services",
+    "financial": "Financial Services",
+    "healthcare": "Healthcare",
+    "health care": "Healthcare",
+    "industrials": "Industrials",
+    "industrial": "Industrials",
+    "real estate": "Real Estate",
+    "technology": "Technology",
+    "tech": "Technology",
+    "utilities": "Utilities",
+    "utility": "Utilities",
+}
+
+# Nouns that must follow a sector keyword for it to be read as a sector, so that
+# "energy companies" matches but "companies that make energy drinks" does not
+SECTOR_NOUNS = ["sector", "sectors", "companies", "company", "firms", "stocks", "businesses"]
+
+US_STATES = {
+    "alabama": "AL", "alaska": "AK", "arizona": "AZ", "arkansas": "AR", "california": "CA",
+    "colorado": "CO", "connecticut": "CT", "delaware": "DE", "florida": "FL", "georgia": "GA",
+    "hawaii": "HI", "idaho": "ID", "illinois": "IL", "indiana": "IN", "iowa": "IA",
+    "kansas": "KS", "kentucky": "KY", "louisiana": "LA", "maine": "ME", "maryland": "MD",
+    "massachusetts": "MA", "michigan": "MI", "minnesota": "MN", "mississippi": "MS", "missouri": "MO",
+    "montana": "MT", "nebraska": "NE", "nevada": "NV", "new hampshire": "NH", "new jersey": "NJ",
+    "new mexico": "NM", "new york": "NY", "north carolina": "NC", "north dakota": "ND", "ohio": "OH",
+    "oklahoma": "OK", "oregon": "OR", "pennsylvania": "PA", "rhode island": "RI", "south carolina": "SC",
+    "south dakota": "SD", "tennessee": "TN", "texas": "TX", "utah": "UT", "vermont": "VT",
+    "virginia": "VA", "washington": "WA", "west virginia": "WV", "wisconsin": "WI", "wyoming": "WY",
+}
+
+MULTIPLIERS = {
+    "trillion": 1_000_000_000_000, "t": 1_000_000_000_000,
+    "billion": 1_000_000_000, "b": 1_000_000_000, "bn": 1_000_000_000,
+    "million": 1_000_000, "m": 1_000_000, "mm": 1_000_000,
+}
+
+COMPARATORS = {
+    "above": "$gt", "over": "$gt", "greater than": "$gt", "more than": "$gt", "at least": "$gte", ">": "$gt",
+    "below": "$lt", "under": "$lt", "less than": "$lt", "at most": "$lte", "<": "$lt",
+}
+
+# Longest alternatives first so "west virginia" wins over "virginia" and so on
+def _alternation(words):
+    return "|".join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+
+SECTOR_PATTERN = re.compile(rf"\b({_alternation(SECTOR_KEYWORDS)})\s+(?:{_alternation(SECTOR_NOUNS)})\b", re.IGNORECASE)
+
+STATE_PATTERN = re.compile(rf"\b(?:in|from|based in|headquartered in)\s+({_alternation(US_STATES)})\b", re.IGNORECASE)
+
+MARKET_CAP_PATTERN = re.compile(
+    rf"\b(?:with\s+(?:a\s+)?)?market\s*cap(?:italization)?\s*({_alternation(COMPARATORS)})\s*\$?\s*(\d+(?:\.\d+)?)\s*({_alternation(MULTIPLIERS)})\b",
+    re.IGNORECASE
+)
+
+RECOMMENDATION_PATTERN = re.compile(r"\b(?:rated|analysts?\s+(?:say|recommend|rate))\s+(?:a\s+)?(buy|hold|sell)\b", re.IGNORECASE)
+
+# Anything left in the query after the rules ran that could still be a metadata filter:
+# numbers, other metadata fields, unmatched sector or state names, or a place name after "in"
+RESIDUAL_FILTER_PATTERN = re.compile(
+    rf"\d|\b(?:p/?e|price[sd]?|volume|city|cities|country|countries|headquartered|based|located|market\s*cap\w*"
+    rf"|analysts?|rat(?:ed|ing)|recommend\w*|sector|{_alternation(SECTOR_KEYWORDS)}|{_alternation(US_STATES)})\b",
+    re.IGNORECASE
+)
+
+# The rules only produce positive conditions, so any negation or exclusion goes to the LLM
+NEGATION_PATTERN = re.compile(r"\b(?:not|non|no|except|excluding|without|outside|other\s+than)\b|n't\b", re.IGNORECASE)
+
+PLACE_PATTERN = re.compile(r"\b(?:in|from)\s+[A-Z][a-z]+")
+
+def _remove_spans(text: str, spans: list) -> str:
+
+    for start, end in sorted(spans, reverse=True):
+        text = text[:start] + " " + text[end:]
+
+    return " ".join(text.split())
+
+def extract_filter(user_query: str):
+
+    """
+    Extracts a Pinecone metadata filter from the user query with keyword and regex rules.
+
+    Args:
+        user_query (str): The natural language query.
+
+    Returns:
+        dict: A dictionary with "filter" and "question" keys, or None if no rule matched
+            or part of the query could still be a filter the rules don't handle, including
+            any negated or excluded condition.
+    """
+
+    if NEGATION_PATTERN.search(user_query):
+        return None
+
+    conditions = []
+    spans = []
+    sector_spans = []
+
+    sectors = []
+    for match in SECTOR_PATTERN.finditer(user_query):
+        sector = SECTOR_KEYWORDS[match.group(1).lower()]
+        if sector not in sectors:
+            sectors.append(sector)
+        sector_spans.append(match.span(1))
+
+    if sectors:
+        conditions.append({"Sector": {"$in": sectors}} if len(sectors) > 1 else {"Sector": {"$eq": sectors[0]}})
+
+    states = []
+    for match in STATE_PATTERN.finditer(user_query):
+        state = US_STATES[match.group(1).lower()]
+        if state not in states:
+            states.append(state)
+        spans.append(match.span())
+
+    if states:
+        conditions.append({"State": {"$in": states}} if len(states) > 1 else {"State": {"$eq": states[0]}})
+
+    match = MARKET_CAP_PATTERN.search(user_query)
+    if match:
+        comparator, amount, unit = match.groups()
+        operator = COMPARATORS[comparator.lower()]
+        conditions.append({"Market Cap": {operator: float(amount) * MULTIPLIERS[unit.lower()]}})
+        spans.append(match.span())
+
+    match = RECOMMENDATION_PATTERN.search(user_query)
+    if match:
+        conditions.append({"Analyst Recommendation": {"$eq": match.group(1).lower()}})
+        spans.append(match.span())
+
+    if not conditions:
+        return None
+
+    # Only trust the rules if they consumed every filterable phrase; otherwise let the LLM handle it
+    residual = _remove_spans(user_query, spans + sector_spans)
+    if RESIDUAL_FILTER_PATTERN.search(residual) or PLACE_PATTERN.search(residual):
+        return None
+
+    # Remove the purely structural phrases; sector words are kept as they also help the semantic search
+    question = _remove_spans(user_query, spans) or user_query
+
+    return {
+        "filter": conditions[0] if len(conditions) == 1 else {"$and": conditions},
+        "question": question
+    }
@@ -0,0 +1,25 @@
+# Launch with: gunicorn -c gunicorn.conf.py app:app
+#
+# Each worker imports the app and loads its own embedding model and Pinecone
+# gRPC channel, since neither is safe to create before forking. gthread workers
+# let each worker overlap the Pinecone and Groq round trips of concurrent requests.
+
+import os
+
+bind = "0.0.0.0:8000"
+workers = 4
+worker_class = "gthread"
+threads = 8
+
+# Split the cores between workers instead of letting each one claim all of them
+threads_per_worker = str(max(1, (os.cpu_count() or 1) // workers))
+os.environ.setdefault("OMP_NUM_THREADS", threads_per_worker)
+os.environ.setdefault("MKL_NUM_THREADS", threads_per_worker)
+
+def post_worker_init(worker):
+
+    # Warm up the per-worker resources so the first request doesn't pay for them
+    import app
+
+    app.get_embed_model()
+    app.get_pinecone_index()
@@ -1,6 +1,6 @@
 import os
 from dotenv import load_dotenv
-from pinecone import Pinecone
+from pinecone.grpc import PineconeGRPC as Pinecone
 import numpy as np
 
 load_dotenv()
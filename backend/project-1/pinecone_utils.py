@@ -1,12 +1,55 @@
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_pinecone import PineconeVectorStore
-from langchain.schema import Document
+import os
+
+# Use every core for intra-op parallelism; must be set before torch is imported
+os.environ.setdefault("OMP_NUM_THREADS", str(os.cpu_count()))
+os.environ.setdefault("MKL_NUM_THREADS", str(os.cpu_count()))
+
+from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
-import concurrent.futures
-import yfinance as yf
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from diskcache import Cache
+from datetime import date
+from pinecone.grpc import PineconeGRPC as Pinecone
+import asyncio
+import aiohttp
+import threading
 import requests
+import torch
+import queue
 import json
-import os   
+
+torch.set_num_threads(os.cpu_count())
+torch.set_grad_enabled(False)
+
+EMBED_MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
+EMBED_BATCH_SIZE = 64
+GPU_EMBED_BATCH_SIZE = 256
+UPSERT_BATCH_SIZE = 100
+
+YAHOO_COOKIE_URL = "https://fc.yahoo.com"
+YAHOO_CRUMB_URL = "https://query2.finance.yahoo.com/v1/test/getcrumb"
+YAHOO_QUOTE_SUMMARY_URL = "https://query2.finance.yahoo.com/v10/finance/quoteSummary/{symbol}"
+YAHOO_MODULES = "price,summaryProfile,assetProfile,financialData,summaryDetail"
+YAHOO_HEADERS = {"User-Agent": "Mozilla/5.0"}
+FETCH_CONCURRENCY = 64
+HTTP_POOL_SIZE = 64
+
+STOCK_CACHE_DIR = "yf_cache"
+STOCK_CACHE_TTL = 24 * 60 * 60
+
+SUCCESSFUL_TICKERS_FILE = "successful_tickers.txt"
+UNSUCCESSFUL_TICKERS_FILE = "unsuccessful_tickers.txt"
+HISTORY_BATCH_SIZE = 256
+
+def chunked(items: list, size: int):
+
+    """
+    Yields successive chunks of at most `size` items from a list.
+    """
+
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
 
 class PineconeUtils:
 
@@ -20,8 +63,31 @@ class PineconeUtils:
         self.namespace = namespace
 
         load_dotenv()
-        
-        PineconeVectorStore(index_name=self.index_name, embedding=HuggingFaceEmbeddings())
+
+        # Load the embedding model once and encode descriptions in batches,
+        # in half precision on the GPU when one is available
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.embed_batch_size = GPU_EMBED_BATCH_SIZE if self.device == "cuda" else EMBED_BATCH_SIZE
+        self.embed_model = SentenceTransformer(EMBED_MODEL_NAME, device=self.device)
+
+        if self.device == "cuda":
+            self.embed_model.half()
+
+        # gRPC index handle so batched upserts can be pipelined over one channel
+        self.pinecone_index = Pinecone(api_key=os.getenv("PINECONE_API_KEY")).Index(self.index_name)
+
+        # Keep-alive HTTP session with retries, reused for every synchronous download
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=Retry(total=3, backoff_factor=0.2)
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Disk cache of stock info so re-runs on the same day skip Yahoo Finance
+        self.stock_cache = Cache(STOCK_CACHE_DIR)
 
         self.successful_tickers, self.unsuccessful_tickers = self._load_history()
 
@@ -44,7 +110,7 @@ class PineconeUtils:
         url = "https://raw.githubusercontent.com/team-headstart/Financial-Analysis-and-Automation-with-LLMs/main/company_tickers.json"
 
         # Making a GET request to the URL
-        response = requests.get(url)
+        response = self.session.get(url)
 
         # Checking if the request was successful
         if response.status_code == 200:
@@ -66,17 +132,17 @@ class PineconeUtils:
 
     def _load_history(self):
 
-        # Initialize tracking lists
+        # Initialize tracking sets
         
-        successful_tickers = []
-        unsuccessful_tickers = []
+        successful_tickers = set()
+        unsuccessful_tickers = set()
 
         # Load existing successful/unsuccessful tickers
         
         try:
             
-            with open('successful_tickers.txt', 'r') as f:
-                successful_tickers = [line.strip() for line in f if line.strip()]
+            with open(SUCCESSFUL_TICKERS_FILE, 'r') as f:
+                successful_tickers = {line.strip() for line in f if line.strip()}
             print(f"LOADED {len(successful_tickers)} SUCCESSFUL TICKERS")
 
         except FileNotFoundError:
@@ -85,8 +151,8 @@ class PineconeUtils:
 
         try:
             
-            with open('unsuccessful_tickers.txt', 'r') as f:
-                unsuccessful_tickers = [line.strip() for line in f if line.strip()]
+            with open(UNSUCCESSFUL_TICKERS_FILE, 'r') as f:
+                unsuccessful_tickers = {line.strip() for line in f if line.strip()}
             print(f"LOADED {len(unsuccessful_tickers)} UNSUCCESSFUL TICKERS")
 
         except FileNotFoundError:
@@ -95,12 +161,28 @@ class PineconeUtils:
 
         return successful_tickers, unsuccessful_tickers
 
-    def _get_stock_info(self, symbol: str) -> dict:
+    async def _get_crumb(self, session: aiohttp.ClientSession) -> str:
+
+        """
+        Obtains the Yahoo Finance session cookie and the crumb required by the quoteSummary endpoint.
+        """
+
+        # The cookie endpoint responds with an error status but still sets the session cookie
+        async with session.get(YAHOO_COOKIE_URL):
+            pass
+
+        async with session.get(YAHOO_CRUMB_URL) as response:
+            response.raise_for_status()
+            return await response.text()
+
+    async def _get_stock_info(self, session: aiohttp.ClientSession, crumb: str, symbol: str) -> dict:
 
         """
         Retrieves and formats detailed information about a stock from Yahoo Finance.
 
         Args:
+            session (aiohttp.ClientSession): The shared HTTP session.
+            crumb (str): The Yahoo Finance crumb for the session.
             symbol (str): The stock ticker symbol to look up.
 
         Returns:
@@ -109,8 +191,21 @@ class PineconeUtils:
                 PE ratio, price, and analyst recommendation.
         """
 
-        data = yf.Ticker(symbol)
-        stock_info = data.info
+        url = YAHOO_QUOTE_SUMMARY_URL.format(symbol=symbol)
+
+        async with session.get(url, params={"modules": YAHOO_MODULES, "crumb": crumb}) as response:
+            response.raise_for_status()
+            payload = await response.json()
+
+        # Flatten the modules into a single dict, unwrapping {"raw": ..., "fmt": ...} values
+        stock_info = {}
+
+        for module in payload["quoteSummary"]["result"][0].values():
+            for key, value in module.items():
+                if isinstance(value, dict):
+                    value = value.get("raw")
+                if value is not None:
+                    stock_info.setdefault(key, value)
 
         properties = {
             "Ticker": stock_info.get("symbol", "Information not available"),
@@ -130,73 +225,205 @@ class PineconeUtils:
 
         return properties
 
-    def _process_stock(self, stock_ticker: str) -> str:
-        
-        # Skip if already processed
-        
-        if stock_ticker in self.successful_tickers:
-            return f"Already processed {stock_ticker}"
+    async def _fetch_stock(self, session: aiohttp.ClientSession, crumb: str, semaphore: asyncio.Semaphore, stock_ticker: str) -> dict:
 
-        try:
-            
-            # Get and store stock data
-            stock_data = self._get_stock_info(stock_ticker)
-            stock_description = stock_data['Business Summary']
-
-            # Store stock description in Pinecone
-            PineconeVectorStore.from_documents(
-                documents=[Document(page_content=stock_description, metadata=stock_data)],
-                embedding=HuggingFaceEmbeddings(),
-                index_name=self.index_name,
-                namespace=self.namespace
+        """
+        Fetches the stock information for a single ticker, bounded by the shared semaphore.
+        Results are served from the disk cache when the ticker was already fetched today.
+
+        Args:
+            session (aiohttp.ClientSession): The shared HTTP session.
+            crumb (str): The Yahoo Finance crumb for the session.
+            semaphore (asyncio.Semaphore): Limits the number of in-flight requests.
+            stock_ticker (str): The stock ticker symbol to fetch.
+
+        Returns:
+            dict: The stock information as returned by _get_stock_info.
+
+        Raises:
+            ValueError: If the stock has no business summary to embed.
+        """
+
+        cache_key = (stock_ticker, date.today().isoformat())
+        stock_data = self.stock_cache.get(cache_key)
+
+        if stock_data is None:
+
+            async with semaphore:
+                stock_data = await self._get_stock_info(session, crumb, stock_ticker)
+
+            self.stock_cache.set(cache_key, stock_data, expire=STOCK_CACHE_TTL)
+
+        if not stock_data["Business Summary"]:
+            raise ValueError("No business summary available")
+
+        return stock_data
+
+    def _write_history(self) -> None:
+
+        """
+        Drains the history queue on a dedicated thread, appending tickers to their
+        history files in batches of HISTORY_BATCH_SIZE. Stops when it receives None.
+        """
+
+        batches = {SUCCESSFUL_TICKERS_FILE: [], UNSUCCESSFUL_TICKERS_FILE: []}
+
+        def flush(path):
+            with open(path, 'a') as f:
+                f.write("\n".join(batches[path]) + "\n")
+                f.flush()
+            batches[path] = []
+
+        while True:
+
+            item = self.history_queue.get()
+
+            if item is None:
+                break
+
+            path, stock_ticker = item
+            batches[path].append(stock_ticker)
+
+            if len(batches[path]) >= HISTORY_BATCH_SIZE:
+                flush(path)
+
+        for path, batch in batches.items():
+            if batch:
+                flush(path)
+
+    def _start_history_writer(self) -> None:
+
+        self.history_queue = queue.Queue()
+        self.history_writer = threading.Thread(target=self._write_history, daemon=True)
+        self.history_writer.start()
+
+    def _stop_history_writer(self) -> None:
+
+        self.history_queue.put(None)
+        self.history_writer.join()
+
+    def _track_success(self, stock_ticker: str) -> None:
+
+        self.history_queue.put((SUCCESSFUL_TICKERS_FILE, stock_ticker))
+        self.successful_tickers.add(stock_ticker)
+
+    def _track_failure(self, stock_ticker: str) -> None:
+
+        self.history_queue.put((UNSUCCESSFUL_TICKERS_FILE, stock_ticker))
+        self.unsuccessful_tickers.add(stock_ticker)
+
+    async def _fetch_stocks(self, tickers: list, max_concurrency: int) -> dict:
+
+        stocks = {}
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        # One keep-alive connection pool sized to the number of in-flight requests
+        connector = aiohttp.TCPConnector(limit=max_concurrency, ttl_dns_cache=300)
+
+        async with aiohttp.ClientSession(headers=YAHOO_HEADERS, connector=connector) as session:
+
+            crumb = await self._get_crumb(session)
+
+            results = await asyncio.gather(
+                *(self._fetch_stock(session, crumb, semaphore, ticker) for ticker in tickers),
+                return_exceptions=True
             )
 
-            # Track success
-            with open('successful_tickers.txt', 'a') as f:
-                f.write(f"{stock_ticker}\n")
+        for ticker, result in zip(tickers, results):
+
+            if isinstance(result, Exception):
+                # Log the exception but continue processing other tickers
+                print(f"ERROR ENCOUNTERED IN {ticker}: {result}")
+                self._track_failure(ticker)
             
-            self.successful_tickers.append(stock_ticker)
+            else:
+                stocks[ticker] = result
 
-            return f"Processed {stock_ticker} successfully"
+        print(f"FETCHED {len(stocks)} OF {len(tickers)} TICKERS")
 
-        except Exception as e:
-            
-            # Track failure
-            with open('unsuccessful_tickers.txt', 'a') as f:
-                f.write(f"{stock_ticker}\n")
-            
-            self.unsuccessful_tickers.append(stock_ticker)
+        return stocks
 
-            return f"ERROR processing {stock_ticker}: {e}"
+    def _embed_and_upsert(self, stocks: dict) -> None:
 
-    def parallel_process_stocks(self, tickers: list, max_workers: int = 10) -> None:
+        """
+        Embeds the business summaries of the fetched stocks in batches and upserts them into Pinecone.
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            
-            future_to_ticker = {
-                executor.submit(self._process_stock, ticker): ticker
-                for ticker in tickers
-            }
+        Args:
+            stocks (dict): A mapping of ticker symbol to stock information.
+        """
+
+        if not stocks:
+            return
+
+        # Sort by token length (capped at what the model actually sees) and encode each
+        # slice of the sorted order as its own batch, so every batch pads to a similar size.
+        # encode() only sorts within the list it is given, which is a single batch here.
+        # The tickers are sorted along with the descriptions, so embeddings stay paired with their ids
+        tickers = list(stocks)
+        token_ids = self.embed_model.tokenizer(
+            [stocks[ticker]["Business Summary"] for ticker in tickers],
+            add_special_tokens=False,
+            truncation=True,
+            max_length=self.embed_model.max_seq_length
+        )["input_ids"]
+        lengths = dict(zip(tickers, map(len, token_ids)))
+
+        tickers.sort(key=lengths.get)
+        descriptions = [stocks[ticker]["Business Summary"] for ticker in tickers]
+
+        print(f"EMBEDDING {len(descriptions)} DESCRIPTIONS...")
+
+        embeddings = []
 
-            for future in concurrent.futures.as_completed(future_to_ticker):
+        with torch.inference_mode():
+            for batch in chunked(descriptions, self.embed_batch_size):
+                embeddings.extend(self.embed_model.encode(batch, batch_size=len(batch), convert_to_numpy=True, device=self.device))
 
-                ticker = future_to_ticker[future]
+        vectors = [
+            {"id": ticker, "values": embedding.tolist(), "metadata": {**stocks[ticker], "text": stocks[ticker]["Business Summary"]}}
+            for ticker, embedding in zip(tickers, embeddings)
+        ]
 
-                try:
-                    result = future.result()
-                    print(result)
+        # Send every batch without waiting for the previous one to be acknowledged
+        pending = [
+            (batch, self.pinecone_index.upsert(vectors=batch, namespace=self.namespace, async_req=True))
+            for batch in chunked(vectors, UPSERT_BATCH_SIZE)
+        ]
 
-                    # Handle errors in the result (if they follow a specific format)
-                    if result.startswith("ERROR"):
-                        print(f"ERROR ENCOUNTERED IN {ticker}: {result}")
+        for batch, result in pending:
+
+            try:
+                result.result()
+
+                for vector in batch:
+                    self._track_success(vector["id"])
+
+            except Exception as exc:
+                print(f"ERROR UPSERTING BATCH STARTING AT {batch[0]['id']}: {exc}")
+
+                for vector in batch:
+                    self._track_failure(vector["id"])
+
+        print(f"UPSERTED {len(vectors)} VECTORS")
+
+    def parallel_process_stocks(self, tickers: list, max_concurrency: int = FETCH_CONCURRENCY) -> None:
+
+        # Skip if already processed
+        tickers = [ticker for ticker in tickers if ticker not in self.successful_tickers]
+
+        self._start_history_writer()
+
+        try:
+            # Fetch stock data concurrently, then embed and upsert in batches
+            stocks = asyncio.run(self._fetch_stocks(tickers, max_concurrency))
+            self._embed_and_upsert(stocks)
 
-                except Exception as exc:
-                    # Log the exception but continue processing other tickers
-                    print(f'{ticker} GENERATED AN EXCEPTION: {exc}')
+        finally:
+            self._stop_history_writer()
 
 pc_utils = PineconeUtils(index_name="stocks", namespace="stock-descriptions")
 
 tickers = pc_utils.get_tickers()
 tickers_to_process = [tickers[num]["ticker"] for num in tickers.keys()]
 
-pc_utils.parallel_process_stocks(tickers_to_process, max_workers=4)
\ No newline at end of file
+pc_utils.parallel_process_stocks(tickers_to_process)
\ No newline at end of file